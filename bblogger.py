@@ -16,7 +16,6 @@ modem Network address.
 """
 
 import configparser
-import csv
 import datetime
 import getopt
 import getpass
@@ -24,7 +23,6 @@ import os.path
 import re
 import socket
 import sys
-import telnetlib
 import time
 
 # Utility product information
@@ -37,27 +35,60 @@ if version_info[3] != 'final':
 
 __description__ = '%s %s.\n%s' % (__product__, __version__, __copyright__)
 
-USAGE = re.search('^usage:.*\n\n', __doc__,
-                  re.MULTILINE | re.DOTALL).group().strip()
+# The usage line is the second paragraph of the module docstring.
+USAGE = __doc__.split('\n\n', 2)[1].strip()
 
 
 def usage(mesg):
     sys.exit('%s\n%s' % (mesg, USAGE))
 
 
-class HoursDelta(datetime.timedelta):
+def positive_int(value, mesg):
+    try:
+        value = int(value)
+        if value < 1:
+            raise ValueError
+    except ValueError:
+        usage(mesg)
+    return value
+
+
+class HoursDelta(object):
+
+    __slots__ = ('hours', 'minutes')
+
+    def __init__(self, hours, minutes):
+        self.hours = hours
+        self.minutes = minutes
 
     def __str__(self):
-        total_seconds = self.total_seconds()
-        hours = total_seconds//3600
-        minutes = (total_seconds % 3600)//60
-        return "%d:%02d" % (hours, minutes)
+        return "%d:%02d" % (self.hours, self.minutes)
+
+
+# Telnet commands, RFC 854.
+IAC = b'\xff'
+DONT = b'\xfe'
+DO = b'\xfd'
+WONT = b'\xfc'
+WILL = b'\xfb'
+SB = b'\xfa'
+SE = b'\xf0'
 
 
 class TelnetConnection(object):
 
+    PORT = 23
+    # Seconds to wait on the modem before treating the session as dead.
+    TIMEOUT = 60
+    # Keepalive timings in seconds, all well inside a one minute check.
+    KEEPALIVE_IDLE = 30
+    KEEPALIVE_INTERVAL = 5
+    KEEPALIVE_COUNT = 4
+
     def __init__(self):
-        self.tn = telnetlib.Telnet()
+        self.sock = None
+        self._buffer = bytearray()
+        self._command = b''
         self.prompt = ''
         self.account = ''
         self.password = ''
@@ -70,24 +101,133 @@ class TelnetConnection(object):
         self.password = password.encode('ascii')
 
     def login(self, host, user, password):
-        self.tn.open(host)
-
-        self.tn.read_until(self.account)
-        self.tn.write(user.encode('ascii') + b'\n')
-
-        self.tn.read_until(self.password)
-        self.tn.write(password.encode('ascii') + b'\n')
-
-        self.tn.read_until(self.prompt)
+        self.sock = socket.create_connection((host, TelnetConnection.PORT),
+                                             TelnetConnection.TIMEOUT)
+        # Commands are short writes that wait on the modem's reply, do not
+        # hold them back for Nagle.
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Probe the session while it idles between checks, the system
+        # default of hours before the first probe is far longer than any
+        # check interval. Where the timings cannot be set keepalive would
+        # do nothing useful so it is left off.
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                                 TelnetConnection.KEEPALIVE_IDLE)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                                 TelnetConnection.KEEPALIVE_INTERVAL)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT,
+                                 TelnetConnection.KEEPALIVE_COUNT)
+        self._buffer = bytearray()
+        self._command = b''
+
+        self.read_until(self.account)
+        self.sock.sendall(user.encode('ascii') + b'\n')
+
+        self.read_until(self.password)
+        self.sock.sendall(password.encode('ascii') + b'\n')
+
+        self.read_until(self.prompt)
 
     def read_command(self, command):
-        self.tn.write(command.encode('ascii') + b'\n')
-        return self.tn.read_until(self.prompt)
+        # Throw away anything left over from earlier replies, such as an
+        # extra prompt, which would otherwise put every later reply out of
+        # step with its command.
+        self._buffer = bytearray()
+        self._command = b''
+        self.sock.setblocking(False)
+        try:
+            while True:
+                if not self.sock.recv(4096):
+                    raise EOFError("telnet connection closed")
+        except BlockingIOError:
+            pass
+        finally:
+            self.sock.settimeout(TelnetConnection.TIMEOUT)
+        self.sock.sendall(command.encode('ascii') + b'\n')
+        return self.read_until(self.prompt)
+
+    def read_until(self, match):
+        buf = self._buffer
+        start = 0
+        while True:
+            i = buf.find(match, start)
+            if i >= 0:
+                i += len(match)
+                data = bytes(buf[:i])
+                del buf[:i]
+                return data
+            start = max(0, len(buf) - len(match) + 1)
+            data = self.sock.recv(4096)
+            if not data:
+                raise EOFError("telnet connection closed")
+            buf += self._cook(data)
+
+    def _cook(self, data):
+        # Strip telnet commands from the modem output, refusing any option
+        # it offers or asks for. A command split across reads is kept until
+        # the rest of it arrives.
+        if self._command:
+            data = self._command + data
+            self._command = b''
+        if IAC not in data:
+            return data.translate(None, b'\0\021')
+        cooked = bytearray()
+        start = 0
+        while True:
+            i = data.find(IAC, start)
+            if i < 0:
+                cooked += data[start:]
+                break
+            cooked += data[start:i]
+            command = data[i+1:i+2]
+            end = i + 2
+            if command in (DO, DONT, WILL, WONT):
+                end += 1
+            elif command == SB:
+                # Skip the subnegotiation up to its IAC SE, stepping over
+                # any commands within it.
+                while end >= 0:
+                    end = data.find(IAC, end)
+                    if end >= 0:
+                        inner = data[end+1:end+2]
+                        if inner == SE:
+                            end += 2
+                            break
+                        end += 2
+                        if inner in (DO, DONT, WILL, WONT):
+                            end += 1
+            if not command or end < 0 or end > len(data):
+                self._command = data[i:]
+                break
+            if command == IAC:
+                cooked += IAC
+            elif command == DO:
+                self.sock.sendall(IAC + WONT + data[i+2:end])
+            elif command == WILL:
+                self.sock.sendall(IAC + DONT + data[i+2:end])
+            start = end
+        return cooked.translate(None, b'\0\021')
 
     def exit(self):
-        self.tn.write(b"exit\n")
-        self.tn.read_all()
-        self.tn.close()
+        if self.sock is None:
+            return
+        # Do not wait for the modem to drop the connection, just take what
+        # has already arrived and close.
+        try:
+            self.sock.sendall(b"exit\n")
+            self.sock.shutdown(socket.SHUT_WR)
+            self.sock.setblocking(False)
+            while self.sock.recv(4096):
+                pass
+        except OSError:
+            pass
+        self.close()
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
 
 
 class ConnectionStats(object):
@@ -112,7 +252,7 @@ class ConnectionStats(object):
     RESET_TIMES = 'Reset Times'
     LINK_TIMES = 'Link Times'
 
-    ALL_STATS = [
+    ALL_STATS = (
         UPTIME,
         RESET_TIMES,
         LINK_TIMES,
@@ -132,7 +272,8 @@ class ConnectionStats(object):
         FE_SNR_MARGIN,
         FE_CRC_COUNT,
         FE_ES_COUNT,
-    ]
+    )
+    STAT_INDEX = {stat: index for index, stat in enumerate(ALL_STATS)}
 
     def __init__(self, modem, reporter):
         self._modem = modem
@@ -147,23 +288,44 @@ class ConnectionStats(object):
         self._perday = log_perday
 
     def log_stats(self):
-        log_datetime = datetime.datetime.now()
+        now = datetime.datetime.now
+        log_datetime = now()
         log_day = log_datetime.day
         self._reporter.start(log_datetime)
         end_time = log_datetime + datetime.timedelta(hours=self._duration)
         print("Logging period ends: %s\n" %
-                end_time.isoformat(sep=' ', timespec='seconds'))
-        while log_datetime < end_time:
-            self._modem.read_stats()
-            if self._perday and log_datetime.day != log_day:
-                log_day = log_datetime.day
-                self._reporter.start(log_datetime)
-            self._reporter.log(log_datetime,
-                    [(stat, str(self._modem[stat])) for stat in
-                        ConnectionStats.ALL_STATS
-                        if self._modem.reports_stat(stat)])
-            time.sleep(self._interval*60 - 0.5)
-            log_datetime = datetime.datetime.now()
+                end_time.isoformat(sep=' ', timespec='seconds'), flush=True)
+        # The modem reports the same stats on every check.
+        stats = tuple((stat, index)
+                      for stat, index in ConnectionStats.STAT_INDEX.items()
+                      if self._modem.reports_stat(stat))
+        interval = self._interval*60
+        deadline = time.monotonic()
+        end = deadline + self._duration*3600
+        try:
+            with self._modem:
+                while True:
+                    self._modem.read_stats()
+                    if self._perday and log_datetime.day != log_day:
+                        log_day = log_datetime.day
+                        self._reporter.start(log_datetime)
+                    values = self._modem.snapshot_str()
+                    self._reporter.log(log_datetime,
+                            [(stat, values[index]) for stat, index in stats])
+                    # Sleep to the next check time so slow polls do not make
+                    # the checks drift, skipping any checks already missed.
+                    deadline += interval
+                    delay = deadline - time.monotonic()
+                    if delay < 0:
+                        missed = -delay//interval + 1
+                        deadline += missed*interval
+                        delay += missed*interval
+                    if deadline >= end:
+                        break
+                    time.sleep(delay)
+                    log_datetime = now()
+        finally:
+            self._reporter.stop()
         print("... logging finished.\n")
 
 
@@ -174,252 +336,400 @@ class BroadBandModem(object):
         self._user = user
         self._password = password
         self._connection = connection
-        self._stats = {}
+        self._stats = ["Unknown"] * len(ConnectionStats.ALL_STATS)
+        self._stats_str = ["Unknown"] * len(ConnectionStats.ALL_STATS)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def __getitem__(self, stat):
-        return self._stats.get(stat, "Unknown")
+        index = ConnectionStats.STAT_INDEX.get(stat)
+        if index is None:
+            return "Unknown"
+        return self._stats[index]
+
+    def snapshot_str(self):
+        # Stat values in ConnectionStats.ALL_STATS order, already formatted
+        # for logging.
+        return self._stats_str
+
+
+def stat_group(stat):
+    return stat.upper().replace(' ', '_')
+
+
+def combine_patterns(patterns):
+    """Combine stat patterns into a single alternation of named groups."""
+    return re.compile(b"|".join(
+        b"(?P<%s>%s)" % (stat_group(stat).encode('ascii'), pattern.pattern)
+        for stat, pattern in patterns))
+
+
+def uptime_value(values):
+    return HoursDelta(hours=int(values[0]), minutes=int(values[1]))
+
+
+def psd_value(values):
+    # The modem pads the fraction, e.g. "19. 9".
+    return float(values[0].replace(b" ", b""))
+
+
+def count_value(values):
+    return int(values[0])
+
+
+def cell_count_value(values):
+    # Cell counts are unsigned 32 bit but the modem shows them signed.
+    value = int(values[0])
+    if value < 0:
+        value += (1<<32)
+    return value
 
 
 class Vigor130Modem(BroadBandModem):
 
-    STATUS_STATS = {
-        ConnectionStats.UPTIME:        rb"System Uptime:(\d+):(\d+)"
-    }
+    STATUS_STATS = (
+        (ConnectionStats.UPTIME,        re.compile(rb"System Uptime:(\d+):(\d+)")),
+    )
     DSL_STATS = {
         'adsl': {
-            'stats': {
-                ConnectionStats.DS_ACTUAL:     rb"DS Actual Rate +: +(\d+)",
-                ConnectionStats.DS_ATTAINABLE: rb"DS Attainable Rate +: +(\d+)",
-                ConnectionStats.DS_PSD:        rb"DS actual PSD +: +(\d+)\. *(\d+)",
-                ConnectionStats.US_ACTUAL:     rb"US Actual Rate +: +(\d+)",
-                ConnectionStats.US_ATTAINABLE: rb"US Attainable Rate +: +(\d+)",
-                ConnectionStats.US_PSD:        rb"US actual PSD +: +(\d+)\. *(\d+)",
-                ConnectionStats.NE_ATTENUATION: rb"NE Current Attenuation +: +(\d+)",
-                ConnectionStats.NE_SNR_MARGIN: rb"Cur SNR Margin +: +(\d+)",
-                ConnectionStats.NE_RCVD_CELLS: rb"NE Rcvd Cells +: +(-?\d+)",
-                ConnectionStats.NE_XMITTED_CELLS: rb"NE Xmitted Cells +: +(-?\d+)",
-                ConnectionStats.NE_CRC_COUNT:  rb"NE CRC Count +: +(\d+)",
-                ConnectionStats.NE_ES_COUNT:   rb"NE ES Count +: +(\d+)",
-                ConnectionStats.FE_ATTENUATION: rb"Far Current Attenuation +: +(\d+)",
-                ConnectionStats.FE_SNR_MARGIN: rb"Far SNR Margin +: +(\d+)",
-                ConnectionStats.FE_CRC_COUNT:  rb"FE CRC Count +: +(\d+)",
-                ConnectionStats.FE_ES_COUNT:   rb"FE  ES Count +: +(\d+)",
-                ConnectionStats.RESET_TIMES:   rb"Xdsl Reset Times +: +(\d+)",
-                ConnectionStats.LINK_TIMES:    rb"Xdsl Link  Times +: +(\d+)"
-            },
+            'stats': (
+                (ConnectionStats.DS_ACTUAL,     re.compile(rb"DS Actual Rate +: +(\d+)")),
+                (ConnectionStats.DS_ATTAINABLE, re.compile(rb"DS Attainable Rate +: +(\d+)")),
+                (ConnectionStats.DS_PSD,        re.compile(rb"DS actual PSD +: +(\d+\. *\d+)")),
+                (ConnectionStats.US_ACTUAL,     re.compile(rb"US Actual Rate +: +(\d+)")),
+                (ConnectionStats.US_ATTAINABLE, re.compile(rb"US Attainable Rate +: +(\d+)")),
+                (ConnectionStats.US_PSD,        re.compile(rb"US actual PSD +: +(\d+\. *\d+)")),
+                (ConnectionStats.NE_ATTENUATION, re.compile(rb"NE Current Attenuation +: +(\d+)")),
+                (ConnectionStats.NE_SNR_MARGIN, re.compile(rb"Cur SNR Margin +: +(\d+)")),
+                (ConnectionStats.NE_RCVD_CELLS, re.compile(rb"NE Rcvd Cells +: +(-?\d+)")),
+                (ConnectionStats.NE_XMITTED_CELLS, re.compile(rb"NE Xmitted Cells +: +(-?\d+)")),
+                (ConnectionStats.NE_CRC_COUNT,  re.compile(rb"NE CRC Count +: +(\d+)")),
+                (ConnectionStats.NE_ES_COUNT,   re.compile(rb"NE ES Count +: +(\d+)")),
+                (ConnectionStats.FE_ATTENUATION, re.compile(rb"Far Current Attenuation +: +(\d+)")),
+                (ConnectionStats.FE_SNR_MARGIN, re.compile(rb"Far SNR Margin +: +(\d+)")),
+                (ConnectionStats.FE_CRC_COUNT,  re.compile(rb"FE CRC Count +: +(\d+)")),
+                (ConnectionStats.FE_ES_COUNT,   re.compile(rb"FE  ES Count +: +(\d+)")),
+                (ConnectionStats.RESET_TIMES,   re.compile(rb"Xdsl Reset Times +: +(\d+)")),
+                (ConnectionStats.LINK_TIMES,    re.compile(rb"Xdsl Link  Times +: +(\d+)")),
+            ),
             'status_cmd': "show adsl"
         },
         'vdsl': {
-            'stats': {
-                ConnectionStats.DS_ACTUAL:     rb"DS Actual Rate +: +(\d+)",
-                ConnectionStats.DS_ATTAINABLE: rb"DS Attainable Rate +: +(\d+)",
-                ConnectionStats.DS_PSD:        rb"DS actual PSD +: +(\d+)\. *(\d+)",
-                ConnectionStats.US_ACTUAL:     rb"US Actual Rate +: +(\d+)",
-                ConnectionStats.US_ATTAINABLE: rb"US Attainable Rate +: +(\d+)",
-                ConnectionStats.US_PSD:        rb"US actual PSD +: +(\d+)\. *(\d+)",
-                ConnectionStats.NE_ATTENUATION: rb"NE Current Attenuation +: +(\d+)",
-                ConnectionStats.NE_SNR_MARGIN: rb"Cur SNR Margin +: +(\d+)",
-                ConnectionStats.NE_CRC_COUNT:  rb"NE CRC Count +: +(\d+)",
-                ConnectionStats.NE_ES_COUNT:   rb"NE ES Count +: +(\d+)",
-                ConnectionStats.FE_ATTENUATION: rb"Far Current Attenuation +: +(\d+)",
-                ConnectionStats.FE_SNR_MARGIN: rb"Far SNR Margin +: +(\d+)",
-                ConnectionStats.FE_CRC_COUNT:  rb"FE CRC Count +: +(\d+)",
-                ConnectionStats.FE_ES_COUNT:   rb"FE  ES Count +: +(\d+)",
-                ConnectionStats.RESET_TIMES:   rb"Xdsl Reset Times +: +(\d+)",
-                ConnectionStats.LINK_TIMES:    rb"Xdsl Link  Times +: +(\d+)"
-            },
+            'stats': (
+                (ConnectionStats.DS_ACTUAL,     re.compile(rb"DS Actual Rate +: +(\d+)")),
+                (ConnectionStats.DS_ATTAINABLE, re.compile(rb"DS Attainable Rate +: +(\d+)")),
+                (ConnectionStats.DS_PSD,        re.compile(rb"DS actual PSD +: +(\d+\. *\d+)")),
+                (ConnectionStats.US_ACTUAL,     re.compile(rb"US Actual Rate +: +(\d+)")),
+                (ConnectionStats.US_ATTAINABLE, re.compile(rb"US Attainable Rate +: +(\d+)")),
+                (ConnectionStats.US_PSD,        re.compile(rb"US actual PSD +: +(\d+\. *\d+)")),
+                (ConnectionStats.NE_ATTENUATION, re.compile(rb"NE Current Attenuation +: +(\d+)")),
+                (ConnectionStats.NE_SNR_MARGIN, re.compile(rb"Cur SNR Margin +: +(\d+)")),
+                (ConnectionStats.NE_CRC_COUNT,  re.compile(rb"NE CRC Count +: +(\d+)")),
+                (ConnectionStats.NE_ES_COUNT,   re.compile(rb"NE ES Count +: +(\d+)")),
+                (ConnectionStats.FE_ATTENUATION, re.compile(rb"Far Current Attenuation +: +(\d+)")),
+                (ConnectionStats.FE_SNR_MARGIN, re.compile(rb"Far SNR Margin +: +(\d+)")),
+                (ConnectionStats.FE_CRC_COUNT,  re.compile(rb"FE CRC Count +: +(\d+)")),
+                (ConnectionStats.FE_ES_COUNT,   re.compile(rb"FE  ES Count +: +(\d+)")),
+                (ConnectionStats.RESET_TIMES,   re.compile(rb"Xdsl Reset Times +: +(\d+)")),
+                (ConnectionStats.LINK_TIMES,    re.compile(rb"Xdsl Link  Times +: +(\d+)")),
+            ),
             'status_cmd': "vdsl status"
         }
     }
 
+    # Stats not listed here are counts.
+    STAT_VALUES = {
+        ConnectionStats.UPTIME:        uptime_value,
+        ConnectionStats.DS_PSD:        psd_value,
+        ConnectionStats.US_PSD:        psd_value,
+        ConnectionStats.NE_RCVD_CELLS: cell_count_value,
+        ConnectionStats.NE_XMITTED_CELLS: cell_count_value
+    }
+
+    GROUP_STATS = {stat_group(stat): (stat, index)
+                   for stat, index in ConnectionStats.STAT_INDEX.items()}
+    STATUS_PATTERN = combine_patterns(STATUS_STATS)
+    DSL_PATTERNS = {dsl: combine_patterns(dsl_stats['stats'])
+                    for dsl, dsl_stats in DSL_STATS.items()}
+
     def __init__(self, *args, **kwargs):
         super(Vigor130Modem, self).__init__(*args, **kwargs)
         self._session = TelnetConnection()
         self._session.set_login('Account:', 'Password: ')
         self._session.set_prompt('> ')
 
-    def read_stats(self):
+    def open(self):
         self._session.login(self._host, self._user, self._password)
 
-        status = self._session.read_command("show status")
+    def close(self):
+        self._session.exit()
 
-        for stat, pattern in Vigor130Modem.STATUS_STATS.items():
-            match = re.search(pattern, status)
-            if match:
-                self._stats[stat] = \
-                    HoursDelta(hours=int(match.group(1)),
-                               minutes=int(match.group(2)))
-            else:
-                print("Did not find status: %s" % stat, file=sys.stderr)
+    def read_stats(self):
+        try:
+            missing = self._read_stats()
+        except (EOFError, OSError):
+            missing = None
+        if missing is None:
+            # The modem dropped the session since the last poll, or a reply
+            # had none of its stats so the replies cannot be trusted to
+            # match the commands. Log in again and try once more.
+            self._session.close()
+            self.open()
+            missing = self._read_stats()
+            if missing is None:
+                missing = self._reported_stats()
+        for stat in missing:
+            print("Did not find status: %s" % stat, file=sys.stderr)
+
+    def _read_stats(self):
+        # Returns the stats not found, or None if a reply had none of them.
+        status = self._session.read_command("show status")
+        status_missing = self._parse_stats(status,
+                                           Vigor130Modem.STATUS_STATS,
+                                           Vigor130Modem.STATUS_PATTERN)
 
         dsl_stats = Vigor130Modem.DSL_STATS[self._connection]
         stats = self._session.read_command(dsl_stats['status_cmd'])
-        for stat, pattern in dsl_stats['stats'].items():
-            match = re.search(pattern, stats)
-            if match:
-                if stat == ConnectionStats.DS_PSD or \
-                        stat == ConnectionStats.US_PSD:
-                    self._stats[stat] = float(b"%s.%s" %
-                            (match.group(1), match.group(2)))
-                else:
-                    value = int(match.group(1))
-                    if value < 0:
-                        value += (1<<32)
-                    self._stats[stat] = value
-            else:
-                print("Did not find status: %s" % stat, file=sys.stderr)
+        dsl_missing = self._parse_stats(stats, dsl_stats['stats'],
+                                        Vigor130Modem.DSL_PATTERNS[self._connection])
+
+        if (len(status_missing) == len(Vigor130Modem.STATUS_STATS) or
+                len(dsl_missing) == len(dsl_stats['stats'])):
+            return None
+        return status_missing + dsl_missing
+
+    def _parse_stats(self, output, stats, pattern):
+        found = set()
+        for match in pattern.finditer(output):
+            stat, index = Vigor130Modem.GROUP_STATS[match.lastgroup]
+            if stat in found:
+                continue
+            found.add(stat)
+            # Stat values are the groups nested inside the named group.
+            values = match.groups()[match.lastindex:]
+            value = Vigor130Modem.STAT_VALUES.get(stat, count_value)(values)
+            self._stats[index] = value
+            self._stats_str[index] = str(value)
+
+        return [stat for stat, _ in stats if stat not in found]
+
+    def _reported_stats(self):
+        return [stat for stat, _ in
+                Vigor130Modem.STATUS_STATS +
+                Vigor130Modem.DSL_STATS[self._connection]['stats']]
+
+    def reports_stat(self, stat):
+        return stat in self._reported_stats()
 
-        self._session.exit()
 
     def reports_stat(self, stat):
-        return stat in Vigor130Modem.DSL_STATS[self._connection]['stats'] or \
-                stat in Vigor130Modem.STATUS_STATS
+        return any(stat == reported for reported, _ in
+                   Vigor130Modem.STATUS_STATS +
+                   Vigor130Modem.DSL_STATS[self._connection]['stats'])
 
 
-def log_filename(log_datetime, extension='log'):
-    return "%s.%s" % (log_datetime.date(), extension)
+def log_filename(log_date, extension='log'):
+    return "%s.%s" % (log_date.isoformat(), extension)
 
 
 class StatsLogger(object):
 
-    def __init__(self, to_file):
+    TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M"
+    BUFFER_SIZE = 1<<16
+
+    def __init__(self, to_file, flush_every=1, fsync=False):
         self._to_file = to_file
+        self._flush_every = flush_every
+        self._unflushed = 0
+        self._fsync = fsync
         self._output = None
+        self._filename = None
+        self._seen_files = set()
         self._new_logfile = True
 
     def start(self, log_datetime, extension='log'):
         if self._to_file:
-            if self._output:
-                self._output.close()
-            filename = log_filename(log_datetime, extension)
-            self._new_logfile = not os.path.exists(filename)
-            open_flags = 'w'
+            filename = log_filename(log_datetime.date(), extension)
+            if self._output and filename == self._filename:
+                return
+            self.stop()
+            self._filename = filename
+            # A file already opened by this run is known to exist.
+            self._new_logfile = filename not in self._seen_files
+            if self._new_logfile:
+                try:
+                    self._output = open(filename, 'xb',
+                                        buffering=StatsLogger.BUFFER_SIZE)
+                except FileExistsError:
+                    self._new_logfile = False
             if not self._new_logfile:
-                open_flags = 'a'
-            self._output = open(filename, open_flags)
+                self._output = open(filename, 'ab',
+                                    buffering=StatsLogger.BUFFER_SIZE)
+            self._seen_files.add(filename)
         else:
-            self._output = sys.stdout
+            self._output = sys.stdout.buffer
 
     def log(self, log_datetime, data):
-        self._output.write("Timestamp: %s\n" %
-                log_datetime.strftime("%Y-%m-%d %H:%M"))
-        for field, value in data:
-            self._output.write("%s: %s\n" % (field, value))
+        self._write("Timestamp: %s\n%s" %
+                (log_datetime.strftime(self.TIMESTAMP_FORMAT),
+                 "".join(["%s: %s\n" % field for field in data])))
+
+    def _write(self, record):
+        self._output.write(record.encode('ascii'))
+        self._unflushed += 1
+        # The stdout byte buffer is not line buffered like sys.stdout so
+        # flush to keep the console up to date.
+        if not self._to_file or \
+                (self._flush_every and self._unflushed >= self._flush_every):
+            self._output.flush()
+            self._unflushed = 0
+
+    def stop(self):
+        if not self._output:
+            return
         self._output.flush()
+        self._unflushed = 0
+        if self._to_file:
+            if self._fsync:
+                os.fsync(self._output.fileno())
+            self._output.close()
+        self._output = None
 
 
 class CSVStatsLogger(StatsLogger):
 
+    # Stat names and values never need quoting, rows end as csv.writer's.
+    LINE_END = "\r\n"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._header = None
+
     def start(self, log_datetime):
         super().start(log_datetime, extension='csv')
-        self._csv = csv.writer(self._output)
 
     def log(self, log_datetime, data):
+        row = ",".join([log_datetime.isoformat(' ', 'seconds')] +
+                [value for _, value in data]) + self.LINE_END
         if self._new_logfile:
-            self._csv.writerow(["Timestamp"] + [field for field, _ in data])
+            # The same stats are logged every time so the header only needs
+            # building once, whatever the number of daily files.
+            if self._header is None:
+                self._header = ",".join(["Timestamp"] +
+                        [field for field, _ in data]) + self.LINE_END
+            row = self._header + row
             self._new_logfile = False
-        self._csv.writerow([log_datetime.isoformat(' ', 'seconds')] +
-                [value for _, value in data])
-        self._output.flush()
+        self._write(row)
 
 
-try:
-    options, pargs = getopt.getopt(sys.argv[1:], "hc:d:fo:p:t:u:")
-except getopt.GetoptError as err:
-    usage(str(err))
-
-if len(pargs) > 1:
-    usage("More than one modem address given.")
-
-host = '192.168.1.1'
-user = 'admin'
-password = ''
-duration = 24
-to_file = False
-fformat = 'dump'
-sleeptime = 15
-connection = 'adsl'
-
-if len(pargs) == 1:
-    host = pargs[0]
-
-if os.path.exists('./bblogger.ini'):
-    config = configparser.ConfigParser()
-    config.read('./bblogger.ini')
-    if host in config.sections():
-        modem = config[host]
-        host = modem.get('host', host)
-        user = modem.get('user', user)
-        password = modem.get('password', password)
-        duration = modem.getint('duration', duration)
-        to_file = modem.getboolean('file', to_file)
-        fformat = modem.get('output', fformat)
-        sleeptime = modem.getint('time', sleeptime)
-        connection = modem.get('connection', connection)
-
-for option, value in options:
-    if option == '-h':
-        print('%s\n%s' % (__description__, __doc__))
-        sys.exit()
-
-    elif option == '-c':
-        connection = value
-
-    elif option == '-d':
-        try:
-            duration = int(value)
-            if duration < 1:
-                raise ValueError
-        except ValueError:
-            usage("Log duration must be integer value greater than 0.")
+FFORMATS = {
+    'dump': StatsLogger,
+    'csv': CSVStatsLogger
+}
 
-    elif option == '-f':
-        to_file = True
+DSLS = {'adsl', 'vdsl'}
 
-    elif option == '-o':
-        fformat = value
 
-    elif option == '-p':
-        password = value
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
 
-    elif option == '-t':
-        try:
-            sleeptime = int(value)
-            if sleeptime < 1:
-                raise ValueError
-        except ValueError:
-            usage("Time between checks must be integer value greater than 0.")
+    try:
+        options, pargs = getopt.getopt(argv, "hc:d:fo:p:t:u:")
+    except getopt.GetoptError as err:
+        usage(str(err))
 
-    elif option == '-u':
-        user = value
+    if len(pargs) > 1:
+        usage("More than one modem address given.")
 
-try:
-    ip = socket.gethostbyname(host)
-except socket.gaierror:
-    usage("Cannot use modem address: %s" % host)
+    host = '192.168.1.1'
+    user = 'admin'
+    password = ''
+    duration = 24
+    to_file = False
+    fformat = 'dump'
+    sleeptime = 15
+    connection = 'adsl'
+    flush_every = 1
+    fsync = False
 
-FFORMATS = {
-    'dump': StatsLogger,
-    'csv': CSVStatsLogger
-}
+    if len(pargs) == 1:
+        host = pargs[0]
 
-if fformat not in FFORMATS:
-    usage("Log format not recognised: %s" % fformat)
+    if os.path.exists('./bblogger.ini'):
+        config = configparser.ConfigParser()
+        config.read('./bblogger.ini')
+        if host in config.sections():
+            modem = config[host]
+            host = modem.get('host', host)
+            user = modem.get('user', user)
+            password = modem.get('password', password)
+            duration = modem.getint('duration', duration)
+            to_file = modem.getboolean('file', to_file)
+            fformat = modem.get('output', fformat)
+            sleeptime = modem.getint('time', sleeptime)
+            connection = modem.get('connection', connection)
+            flush_every = modem.getint('flush', flush_every)
+            fsync = modem.getboolean('fsync', fsync)
 
-DSLS = {'adsl', 'vdsl'}
+    for option, value in options:
+        if option == '-h':
+            print('%s\n%s' % (__description__, __doc__))
+            sys.exit()
+
+        elif option == '-c':
+            connection = value
+
+        elif option == '-d':
+            duration = positive_int(value,
+                    "Log duration must be integer value greater than 0.")
+
+        elif option == '-f':
+            to_file = True
+
+        elif option == '-o':
+            fformat = value
+
+        elif option == '-p':
+            password = value
+
+        elif option == '-t':
+            sleeptime = positive_int(value,
+                    "Time between checks must be integer value greater than 0.")
+
+        elif option == '-u':
+            user = value
+
+    try:
+        ip = socket.gethostbyname(host)
+    except socket.gaierror:
+        usage("Cannot use modem address: %s" % host)
+
+    if fformat not in FFORMATS:
+        usage("Log format not recognised: %s" % fformat)
+
+    if connection not in DSLS:
+        usage("Connection technology not recognised: %s" % connection)
+
+    if not password:
+        password = getpass.getpass()
 
-if connection not in DSLS:
-    usage("Connection technology not recognised: %s" % connection)
+    # Connect by the address already looked up, reconnects then need no DNS.
+    modem = Vigor130Modem(ip, user, password, connection)
 
-if not password:
-    password = getpass.getpass()
+    logger = FFORMATS[fformat](to_file, flush_every, fsync)
 
-modem = Vigor130Modem(host, user, password, connection)
+    cs = ConnectionStats(modem, logger)
+    cs.set_periods(duration, sleeptime, to_file)
+    cs.log_stats()
 
-logger = FFORMATS[fformat](to_file)
 
-cs = ConnectionStats(modem, logger)
-cs.set_periods(duration, sleeptime, to_file)
-cs.log_stats()
+if __name__ == '__main__':
+    main()
 
 # eof